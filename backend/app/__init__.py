@@ -2,15 +2,19 @@
 Spatial Agent Backend Application
 """
 
+from typing import Optional
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.types import Lifespan
 
-from app.config import settings
+from app.config import get_settings
 from app.routers import register_routers
 
 
-def create_app() -> FastAPI:
+def create_app(lifespan: Optional[Lifespan[FastAPI]] = None) -> FastAPI:
     """Create and configure FastAPI application"""
+    settings = get_settings()
 
     app = FastAPI(
         title="Spatial Agent API",
@@ -18,6 +22,7 @@ def create_app() -> FastAPI:
         version="0.1.0",
         docs_url="/docs" if settings.DEBUG else None,
         redoc_url="/redoc" if settings.DEBUG else None,
+        lifespan=lifespan,
     )
 
     # Configure CORS
@@ -2,16 +2,21 @@
 Agent Controller - Chat and Agent interactions with spatial query support
 """
 
-import json
+import asyncio
 import logging
 import re
-from typing import Optional
+from functools import lru_cache
+from typing import Any, AsyncGenerator, Optional
+
+import orjson
 from fastapi import APIRouter
 from fastapi.responses import StreamingResponse
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 
-from app.services.llm import llm_service
-from app.services.spatial import spatial_service
+try:
+    import ahocorasick
+except ImportError:  # Optional accelerator, see the "speedups" extra
+    ahocorasick = None
 
 logger = logging.getLogger(__name__)
 
@@ -50,16 +55,114 @@ SPATIAL_QUERY_KEYWORDS = [
 ]
 
 
+def _build_keyword_matcher():
+    """
+    Build a single-pass matcher over SPATIAL_QUERY_KEYWORDS.
+
+    Returns a callable that takes a lowercased message and yields every
+    keyword occurring in it (overlapping matches included, like `kw in msg`).
+    Uses an Aho-Corasick automaton when pyahocorasick is installed, otherwise
+    a compiled lookahead alternation that tries every start position once.
+    """
+    keywords = sorted({kw.lower() for kw in SPATIAL_QUERY_KEYWORDS}, key=len, reverse=True)
+
+    if ahocorasick is not None:
+        automaton = ahocorasick.Automaton()
+        for kw in keywords:
+            automaton.add_word(kw, kw)
+        automaton.make_automaton()
+
+        def iter_matches(text: str):
+            for _, kw in automaton.iter(text):
+                yield kw
+
+        return iter_matches
+
+    pattern = re.compile("(?=(" + "|".join(map(re.escape, keywords)) + "))")
+
+    def iter_matches(text: str):
+        for match in pattern.finditer(text):
+            yield match.group(1)
+
+    return iter_matches
+
+
+_iter_keyword_matches = _build_keyword_matcher()
+
+# English keywords as whole tokens, for a set-intersection fast path
+_ASCII_KEYWORDS = frozenset(kw for kw in SPATIAL_QUERY_KEYWORDS if kw.isascii())
+_ASCII_TOKEN_RE = re.compile(r"[a-z]+")
+
+
+# Messages longer than this are pasted documents, not spatial queries
+MAX_SPATIAL_QUERY_LENGTH = 4096
+
+
 def is_spatial_query(message: str) -> bool:
     """Check if the message is a spatial query request"""
+    if len(message) > MAX_SPATIAL_QUERY_LENGTH:
+        return False
+    # Only the prefix is classified, which bounds both scan cost and cache key size
+    return _classify(message[:512])
+
+
+@lru_cache(maxsize=2048)
+def _classify(message: str) -> bool:
+    """Keyword classification behind is_spatial_query (pure, memoized)"""
     message_lower = message.lower()
-    match_count = sum(1 for kw in SPATIAL_QUERY_KEYWORDS if kw in message_lower)
-    # Need at least 2 keyword matches to be considered a spatial query
-    return match_count >= 2
+
+    # Fast path: two whole-word English keywords are enough on their own.
+    # Tokens are produced lazily so the scan stops at the second hit.
+    seen = set()
+    for match in _ASCII_TOKEN_RE.finditer(message_lower):
+        token = match.group()
+        if token in _ASCII_KEYWORDS:
+            seen.add(token)
+            if len(seen) >= 2:
+                return True
+
+    # Whole-word hits are substring hits too, so the matcher carries them over
+    for kw in _iter_keyword_matches(message_lower):
+        seen.add(kw)
+        # Need at least 2 distinct keyword matches to be considered a spatial query
+        if len(seen) >= 2:
+            return True
+    return False
+
+
+# Fixed SSE frame sent when a response is complete
+_SSE_DONE = b'data: {"type":"done"}\n\n'
+
+_SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no",
+}
+
+
+def _sse_event(payload: dict) -> bytes:
+    """Encode a payload as an SSE data frame (UTF-8 bytes, no re-encoding needed)"""
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+
+# Streamed tokens are flushed once this many characters or seconds accumulate
+SSE_BATCH_CHARS = 64
+SSE_BATCH_SECONDS = 0.05
+
+# Token frames have a fixed shape, so only the content string is serialized
+_SSE_TOKEN_PREFIX = b'data: {"type":"token","content":'
+_SSE_TOKEN_SUFFIX = b"}\n\n"
+
+
+def _sse_token(content: str) -> bytes:
+    """Encode a token frame without building an intermediate dict"""
+    return _SSE_TOKEN_PREFIX + orjson.dumps(content) + _SSE_TOKEN_SUFFIX
 
 
 class ChatRequest(BaseModel):
     """Chat request model"""
+    model_config = ConfigDict(frozen=True)
+
     message: str
     session_id: Optional[str] = None
     context: Optional[dict] = None
@@ -67,11 +170,44 @@ class ChatRequest(BaseModel):
 
 class ChatResponse(BaseModel):
     """Chat response model"""
+    model_config = ConfigDict(frozen=True)
+
     session_id: str
     message: str
     metadata: Optional[dict] = None
 
 
+async def _agent_pipeline(request: ChatRequest) -> AsyncGenerator[tuple[str, Any], None]:
+    """
+    Shared agent core behind /chat and /chat/stream.
+
+    Yields (kind, payload) events:
+    - ("status", str): progress notice sent before a spatial query runs
+    - ("spatial_result", dict): result of spatial_service.query_natural_language
+    - ("token", str): a token of the conversational LLM response
+    """
+    from app.services.llm import llm_service
+    from app.services.spatial import spatial_service
+
+    # Check if this is a spatial query
+    if is_spatial_query(request.message):
+        logger.info("Detected spatial query intent")
+        yield "status", "正在执行空间查询..."
+        result = await spatial_service.query_natural_language(
+            query=request.message,
+            max_rows=50,  # Limit for chat context
+        )
+        yield "spatial_result", result
+        return
+
+    # Regular conversation
+    async for token in llm_service.chat_stream(
+        message=request.message,
+        system_prompt=SYSTEM_PROMPT,
+    ):
+        yield "token", token
+
+
 @router.post("/chat")
 async def chat(request: ChatRequest) -> ChatResponse:
     """
@@ -82,116 +218,96 @@ async def chat(request: ChatRequest) -> ChatResponse:
     2. If yes, generate SQL, execute query, and format results
     3. If no, respond with general conversation
     """
-    logger.info(f"Chat request: {request.message[:50]}...")
+    from app.services.llm import llm_service
 
-    # Check if this is a spatial query
-    if is_spatial_query(request.message):
-        logger.info("Detected spatial query intent")
-        return await handle_spatial_query(request)
+    logger.info("Chat request: %s...", request.message[:50])
 
-    # Regular conversation
-    response_text = await llm_service.chat(
-        message=request.message,
-        system_prompt=SYSTEM_PROMPT,
-    )
+    session_id = request.session_id or "default"
+    result = None
+    tokens: list[str] = []
+
+    try:
+        async for kind, payload in _agent_pipeline(request):
+            if kind == "spatial_result":
+                result = payload
+            elif kind == "token":
+                tokens.append(payload)
+    except Exception as e:
+        logger.error("Chat error: %s", e)
+        return ChatResponse(
+            session_id=session_id,
+            message=f"处理查询时发生错误: {str(e)}",
+            metadata={"type": "error", "error": str(e)},
+        )
+
+    if result is not None:
+        response_text, metadata = summarize_spatial_result(request.message, result)
+        return ChatResponse(session_id=session_id, message=response_text, metadata=metadata)
 
     return ChatResponse(
-        session_id=request.session_id or "default",
-        message=response_text,
+        session_id=session_id,
+        message="".join(tokens),
         metadata={"provider": llm_service.provider, "type": "conversation"},
     )
 
 
-async def handle_spatial_query(request: ChatRequest) -> ChatResponse:
-    """Handle spatial query requests"""
-    try:
-        # Execute spatial query
-        result = await spatial_service.query_natural_language(
-            query=request.message,
-            max_rows=50,  # Limit for chat context
+def summarize_spatial_result(query: str, result: dict) -> tuple[str, dict]:
+    """Build the reply text and metadata for a spatial query result"""
+    sql = result.get("sql", "")
+
+    if result["success"]:
+        data, row_count, exec_time = (
+            result["data"], result["row_count"], result["execution_time_ms"]
         )
 
-        if result["success"]:
-            # Format the results for the user
-            data = result["data"]
-            row_count = result["row_count"]
-            sql = result["sql"]
-            exec_time = result["execution_time_ms"]
-
-            # Build response message
-            if row_count == 0:
-                response_text = f"查询完成，没有找到符合条件的数据。\n\n**执行的 SQL:**\n```sql\n{sql}\n```"
-            else:
-                # Format data as a readable summary
-                response_text = format_query_results(request.message, data, sql, row_count, exec_time)
-
-            return ChatResponse(
-                session_id=request.session_id or "default",
-                message=response_text,
-                metadata={
-                    "type": "spatial_query",
-                    "sql": sql,
-                    "row_count": row_count,
-                    "execution_time_ms": exec_time,
-                    "data": data[:10],  # Include first 10 rows in metadata
-                },
-            )
+        # Build response message
+        if row_count == 0:
+            response_text = f"查询完成，没有找到符合条件的数据。\n\n**执行的 SQL:**\n```sql\n{sql}\n```"
         else:
-            # Query failed
-            error_msg = result.get("error", "未知错误")
-            sql = result.get("sql", "")
-
-            return ChatResponse(
-                session_id=request.session_id or "default",
-                message=f"查询执行失败: {error_msg}\n\n**尝试的 SQL:**\n```sql\n{sql}\n```",
-                metadata={
-                    "type": "spatial_query_error",
-                    "error": error_msg,
-                    "sql": sql,
-                },
-            )
+            # Format data as a readable summary
+            response_text = format_query_results(query, data, sql, row_count, exec_time)
+
+        return response_text, {
+            "type": "spatial_query",
+            "sql": sql,
+            "row_count": row_count,
+            "execution_time_ms": exec_time,
+            "data": data[:10],  # Include first 10 rows in metadata
+        }
+
+    # Query failed
+    error_msg = result.get("error", "未知错误")
+
+    return f"查询执行失败: {error_msg}\n\n**尝试的 SQL:**\n```sql\n{sql}\n```", {
+        "type": "spatial_query_error",
+        "error": error_msg,
+        "sql": sql,
+    }
 
-    except Exception as e:
-        logger.error(f"Spatial query error: {e}")
-        return ChatResponse(
-            session_id=request.session_id or "default",
-            message=f"处理查询时发生错误: {str(e)}",
-            metadata={"type": "error", "error": str(e)},
-        )
+
+def _format_row(row: dict) -> str:
+    """Format a single result row as "col: value" pairs, skipping NULLs"""
+    return ", ".join(
+        f"{col}: {value:.4f}" if type(value) is float else f"{col}: {value}"
+        for col, value in row.items()
+        if value is not None
+    )
 
 
 def format_query_results(query: str, data: list, sql: str, row_count: int, exec_time: float) -> str:
     """Format query results into a readable message"""
-    lines = []
-
-    lines.append(f"**查询结果** (共 {row_count} 条记录，耗时 {exec_time:.2f}ms)")
-    lines.append("")
+    lines = [f"**查询结果** (共 {row_count} 条记录，耗时 {exec_time:.2f}ms)", ""]
 
-    # Format data as a table-like structure
+    # Format data as a table-like structure (rows share the column order of the query)
     if data:
-        # Get column names from first row
-        columns = list(data[0].keys())
-
         # Show first few rows
         max_rows = min(10, len(data))
-        for i, row in enumerate(data[:max_rows]):
-            row_strs = []
-            for col in columns:
-                value = row.get(col)
-                if value is not None:
-                    # Format floats
-                    if isinstance(value, float):
-                        row_strs.append(f"{col}: {value:.4f}")
-                    else:
-                        row_strs.append(f"{col}: {value}")
-            lines.append(f"{i+1}. " + ", ".join(row_strs))
+        lines.extend(f"{i}. {_format_row(row)}" for i, row in enumerate(data[:max_rows], 1))
 
         if row_count > max_rows:
             lines.append(f"... 还有 {row_count - max_rows} 条记录")
 
-    lines.append("")
-    lines.append("**执行的 SQL:**")
-    lines.append(f"```sql\n{sql}\n```")
+    lines += ["", "**执行的 SQL:**", f"```sql\n{sql}\n```"]
 
     return "\n".join(lines)
 
@@ -199,65 +315,54 @@ def format_query_results(query: str, data: list, sql: str, row_count: int, exec_
 @router.post("/chat/stream")
 async def chat_stream(request: ChatRequest) -> StreamingResponse:
     """Stream chat responses using SSE"""
-    logger.info(f"Stream chat request: {request.message[:50]}...")
+    logger.info("Stream chat request: %s...", request.message[:50])
 
     async def generate():
+        loop = asyncio.get_running_loop()
+        buffer: list[str] = []
+        buffered = 0
+        last_flush = loop.time()
+
         try:
-            # Check if this is a spatial query
-            if is_spatial_query(request.message):
-                # For spatial queries, we don't stream - just return the result
-                yield f"data: {json.dumps({'type': 'token', 'content': '正在执行空间查询...'}, ensure_ascii=False)}\n\n"
-
-                result = await spatial_service.query_natural_language(
-                    query=request.message,
-                    max_rows=50,
-                )
-
-                if result["success"]:
-                    formatted = format_query_results(
-                        request.message,
-                        result["data"],
-                        result["sql"],
-                        result["row_count"],
-                        result["execution_time_ms"],
-                    )
-                    yield f"data: {json.dumps({'type': 'token', 'content': formatted}, ensure_ascii=False)}\n\n"
-                else:
-                    error_msg = f"查询失败: {result.get('error', '未知错误')}"
-                    yield f"data: {json.dumps({'type': 'token', 'content': error_msg}, ensure_ascii=False)}\n\n"
-
-                yield f"data: {json.dumps({'type': 'done'})}\n\n"
-                return
-
-            # Regular streaming conversation
-            async for token in llm_service.chat_stream(
-                message=request.message,
-                system_prompt=SYSTEM_PROMPT,
-            ):
-                event_data = json.dumps({"type": "token", "content": token}, ensure_ascii=False)
-                yield f"data: {event_data}\n\n"
-
-            yield f"data: {json.dumps({'type': 'done'})}\n\n"
+            async for kind, payload in _agent_pipeline(request):
+                if kind == "token":
+                    # Conversational tokens are batched into fewer frames
+                    buffer.append(payload)
+                    buffered += len(payload)
+                    if buffered >= SSE_BATCH_CHARS or loop.time() - last_flush >= SSE_BATCH_SECONDS:
+                        yield _sse_token("".join(buffer))
+                        buffer.clear()
+                        buffered = 0
+                        last_flush = loop.time()
+                elif kind == "status":
+                    yield _sse_token(payload)
+                elif kind == "spatial_result":
+                    # Spatial queries are not streamed - the whole result is sent at once
+                    response_text, _ = summarize_spatial_result(request.message, payload)
+                    yield _sse_token(response_text)
+
+            if buffer:
+                yield _sse_token("".join(buffer))
+
+            yield _SSE_DONE
 
         except Exception as e:
-            logger.error(f"Stream error: {e}")
-            error_data = json.dumps({"type": "error", "message": str(e)}, ensure_ascii=False)
-            yield f"data: {error_data}\n\n"
+            logger.error("Stream error: %s", e)
+            yield _sse_event({"type": "error", "message": str(e)})
 
     return StreamingResponse(
         generate(),
         media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no",
-        },
+        headers=_SSE_HEADERS,
     )
 
 
 @router.get("/config")
 async def get_config() -> dict:
     """Get current LLM configuration (without sensitive data)"""
+    from app.services.llm import llm_service
+    from app.services.spatial import spatial_service
+
     config = llm_service.config.copy()
     if "api_key" in config:
         config["api_key"] = "***" if config["api_key"] else None
@@ -4,13 +4,15 @@ Device Controller - Device management and control
 
 from typing import Optional, List
 from fastapi import APIRouter, HTTPException
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 
 router = APIRouter()
 
 
 class DeviceResponse(BaseModel):
     """Device information response"""
+    model_config = ConfigDict(frozen=True)
+
     id: str
     name: str
     type: str
@@ -50,6 +52,8 @@ async def get_device_status(device_id: str) -> dict:
 
 class CommandRequest(BaseModel):
     """Device command request"""
+    model_config = ConfigDict(frozen=True)
+
     action: str
     parameters: Optional[dict] = None
     priority: Optional[int] = 5
@@ -88,6 +92,8 @@ async def cancel_command(device_id: str, command_id: str) -> dict:
 
 class MissionRequest(BaseModel):
     """Mission creation request"""
+    model_config = ConfigDict(frozen=True)
+
     name: str
     waypoints: List[dict]
     description: Optional[str] = None
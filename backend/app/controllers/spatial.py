@@ -3,11 +3,9 @@ Spatial Controller - Spatial queries and analysis
 """
 
 import logging
-from typing import Optional, List
+from typing import Dict, List, Literal, Optional, Union
 from fastapi import APIRouter, HTTPException
-from pydantic import BaseModel
-
-from app.services.spatial import spatial_service
+from pydantic import BaseModel, ConfigDict
 
 logger = logging.getLogger(__name__)
 
@@ -16,15 +14,20 @@ router = APIRouter()
 
 class SpatialQueryRequest(BaseModel):
     """Spatial query request"""
+    model_config = ConfigDict(frozen=True)
+
     query: str  # Natural language query
     max_rows: Optional[int] = 100
+    layout: Literal["rows", "columns"] = "rows"  # "columns" returns {column: [values]}
 
 
 class SpatialQueryResponse(BaseModel):
     """Spatial query response"""
+    model_config = ConfigDict(frozen=True)
+
     success: bool
     sql: str
-    data: List[dict]
+    data: Union[List[dict], Dict[str, list]]
     row_count: int
     execution_time_ms: float
     error: Optional[str] = None
@@ -43,12 +46,15 @@ async def execute_query(request: SpatialQueryRequest) -> SpatialQueryResponse:
     - "统计每架无人机的平均速度"
     - "查找北京区域内的所有地理围栏"
     """
-    logger.info(f"Spatial query: {request.query}")
+    from app.services.spatial import spatial_service
+
+    logger.info("Spatial query: %s", request.query)
 
     try:
         result = await spatial_service.query_natural_language(
             query=request.query,
             max_rows=request.max_rows or 100,
+            layout=request.layout,
         )
 
         return SpatialQueryResponse(
@@ -60,7 +66,7 @@ async def execute_query(request: SpatialQueryRequest) -> SpatialQueryResponse:
             error=result.get("error"),
         )
     except Exception as e:
-        logger.error(f"Query error: {e}")
+        logger.error("Query error: %s", e)
         return SpatialQueryResponse(
             success=False,
             sql="",
@@ -74,11 +80,15 @@ async def execute_query(request: SpatialQueryRequest) -> SpatialQueryResponse:
 @router.get("/stats")
 async def get_database_stats() -> dict:
     """Get database statistics"""
+    from app.services.spatial import spatial_service
+
     return await spatial_service.get_database_stats()
 
 
 class TrajectoryRequest(BaseModel):
     """Trajectory query request"""
+    model_config = ConfigDict(frozen=True)
+
     entity_id: Optional[str] = None
     start_time: Optional[str] = None
     end_time: Optional[str] = None
@@ -89,25 +99,21 @@ class TrajectoryRequest(BaseModel):
 @router.post("/trajectory")
 async def query_trajectory(request: TrajectoryRequest) -> dict:
     """Query trajectory data"""
-    # Build natural language query
-    query_parts = []
-
-    if request.entity_id:
-        query_parts.append(f"无人机 {request.entity_id} 的")
-    else:
-        query_parts.append("所有无人机的")
+    from app.services.spatial import spatial_service
 
-    query_parts.append("轨迹数据")
+    # Build natural language query
+    entity = f"无人机 {request.entity_id} 的" if request.entity_id else "所有无人机的"
 
     if request.start_time and request.end_time:
-        query_parts.append(f"，时间范围从 {request.start_time} 到 {request.end_time}")
+        time_range = f"，时间范围从 {request.start_time} 到 {request.end_time}"
     elif request.start_time:
-        query_parts.append(f"，从 {request.start_time} 开始")
+        time_range = f"，从 {request.start_time} 开始"
+    else:
+        time_range = ""
 
-    if request.bbox:
-        query_parts.append(f"，在区域 [{request.bbox}] 内")
+    area = f"，在区域 [{request.bbox}] 内" if request.bbox else ""
 
-    query = "".join(query_parts)
+    query = f"{entity}轨迹数据{time_range}{area}"
 
     result = await spatial_service.query_natural_language(query, request.limit or 1000)
 
@@ -123,6 +129,8 @@ async def query_trajectory(request: TrajectoryRequest) -> dict:
 @router.post("/trajectory/analyze")
 async def analyze_trajectory(request: TrajectoryRequest) -> dict:
     """Analyze trajectory data - calculate statistics"""
+    from app.services.spatial import spatial_service
+
     # Build analysis query
     entity_filter = f"无人机 {request.entity_id}" if request.entity_id else "所有无人机"
     query = f"统计{entity_filter}的轨迹点数量、平均速度、平均高度和总距离"
@@ -145,6 +153,8 @@ async def analyze_trajectory(request: TrajectoryRequest) -> dict:
 
 class GeoFenceRequest(BaseModel):
     """Geofence query request"""
+    model_config = ConfigDict(frozen=True)
+
     name: Optional[str] = None
     fence_type: Optional[str] = None
     is_active: Optional[bool] = True
@@ -156,15 +166,15 @@ async def list_geofences(
     is_active: Optional[bool] = None
 ) -> dict:
     """List all geofences"""
-    query_parts = ["查询所有地理围栏"]
+    from app.services.spatial import spatial_service
 
-    if fence_type:
-        query_parts.append(f"，类型为 {fence_type}")
+    type_filter = f"，类型为 {fence_type}" if fence_type else ""
     if is_active is not None:
-        status = "启用" if is_active else "禁用"
-        query_parts.append(f"，状态为{status}")
+        status_filter = f"，状态为{'启用' if is_active else '禁用'}"
+    else:
+        status_filter = ""
 
-    query = "".join(query_parts)
+    query = f"查询所有地理围栏{type_filter}{status_filter}"
     result = await spatial_service.query_natural_language(query, 100)
 
     return {
@@ -175,31 +185,36 @@ async def list_geofences(
     }
 
 
+# Point-in-fence check, parameterized so the prepared statement is reused
+_FENCE_CHECK_SQL = """
+    SELECT
+        id, name, fence_type,
+        ST_Contains(
+            boundary,
+            ST_SetSRID(ST_MakePoint($1, $2), 4326)
+        ) as is_inside
+    FROM geo_fence
+    WHERE id = $3
+"""
+
+
 class PointCheckRequest(BaseModel):
     """Point check request"""
+    model_config = ConfigDict(frozen=True)
+
     longitude: float
     latitude: float
 
 
 @router.post("/geofence/{fence_id}/check")
-async def check_geofence(fence_id: str, point: PointCheckRequest) -> dict:
+async def check_geofence(fence_id: int, point: PointCheckRequest) -> dict:
     """Check if a point is inside a geofence"""
-    query = f"检查点 ({point.longitude}, {point.latitude}) 是否在围栏 ID {fence_id} 内"
-
-    # Direct SQL for this specific query
-    sql = f"""
-    SELECT
-        id, name, fence_type,
-        ST_Contains(
-            boundary,
-            ST_SetSRID(ST_MakePoint({point.longitude}, {point.latitude}), 4326)
-        ) as is_inside
-    FROM geo_fence
-    WHERE id = {fence_id}
-    """
+    from app.services.spatial import spatial_service
 
     try:
-        results, exec_time = await spatial_service.execute_query(sql, 1)
+        results, exec_time = await spatial_service.execute_query(
+            _FENCE_CHECK_SQL, 1, params=(point.longitude, point.latitude, fence_id)
+        )
         if results:
             return {
                 "fence_id": fence_id,
@@ -227,14 +242,12 @@ async def list_devices(
     status: Optional[str] = None
 ) -> dict:
     """List all devices with their current status and location"""
-    query_parts = ["查询所有设备的状态和位置"]
+    from app.services.spatial import spatial_service
 
-    if device_type:
-        query_parts.append(f"，设备类型为 {device_type}")
-    if status:
-        query_parts.append(f"，状态为 {status}")
+    type_filter = f"，设备类型为 {device_type}" if device_type else ""
+    status_filter = f"，状态为 {status}" if status else ""
 
-    query = "".join(query_parts)
+    query = f"查询所有设备的状态和位置{type_filter}{status_filter}"
     result = await spatial_service.query_natural_language(query, 100)
 
     return {
@@ -2,52 +2,107 @@
 LLM Service - Handles LLM interactions with multiple providers
 """
 
-import json
 import logging
+from contextlib import aclosing
 from typing import AsyncGenerator, Optional
 
 import httpx
+import orjson
 
-from app.config import settings
+from app.config import get_settings
 
 logger = logging.getLogger(__name__)
 
+# Request timeout in seconds
+STREAM_TIMEOUT = 120.0
+
+
+class LLMError(Exception):
+    """An LLM request failed; the message is suitable for showing to the user"""
+
+
+def _anthropic_system(system_prompt: str) -> list[dict]:
+    """
+    Build an Anthropic system block marked for prompt caching.
+
+    System prompts are module constants, so marking them ephemeral lets the
+    API reuse the cached prefix across requests instead of reprocessing it.
+    Only prompts above the model's minimum cacheable length (1024 tokens or
+    more) are cached, which in practice means the SQL generation prompt with
+    its schema; shorter ones are processed as usual. OpenAI-compatible
+    providers cache a repeated leading system message automatically and need
+    no marker.
+    """
+    return [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
+
+
+async def _iter_sse_data(response: httpx.Response) -> AsyncGenerator[str, None]:
+    """
+    Yield the data payload of each server-sent event in a streamed response.
+
+    An event may span several "data:" lines; they are collected in a list and
+    joined once when the blank line ending the event arrives.
+    """
+    parts: list[str] = []
+    async for line in response.aiter_lines():
+        if line.startswith("data:"):
+            value = line[5:]
+            parts.append(value[1:] if value.startswith(" ") else value)
+        elif not line and parts:
+            yield "\n".join(parts)
+            parts.clear()
+
+    if parts:
+        yield "\n".join(parts)
+
 
 class LLMService:
     """Service for interacting with LLM providers"""
 
     def __init__(self):
-        self.config = settings.get_llm_config()
+        self.config = get_settings().get_llm_config()
         self.provider = self.config.get("provider")
+        self.api_key = self.config.get("api_key")
+        self.model = self.config.get("model")
+        self.base_url = self.config.get("base_url", "https://models.inference.ai.azure.com")
+
+        # Request headers are the same for every call to the configured provider
+        if self.provider == "anthropic":
+            self._headers = {
+                "x-api-key": self.api_key,
+                "anthropic-version": "2023-06-01",
+                "Content-Type": "application/json",
+            }
+        else:
+            self._headers = {
+                "Authorization": f"Bearer {self.api_key}",
+                "Content-Type": "application/json",
+            }
 
         if not self.provider:
             logger.warning("No LLM provider configured. Set ANTHROPIC_API_KEY, OPENAI_API_KEY, or GITHUB_TOKEN")
 
-    async def chat(self, message: str, system_prompt: Optional[str] = None) -> str:
-        """
-        Send a message to the LLM and get a response.
-
-        Args:
-            message: User message
-            system_prompt: Optional system prompt
-
-        Returns:
-            LLM response text
-        """
-        if not self.provider:
-            return "错误: 未配置 LLM 提供商。请在 .env 文件中设置 GITHUB_TOKEN、ANTHROPIC_API_KEY 或 OPENAI_API_KEY。"
-
-        if self.provider == "github":
-            return await self._chat_github(message, system_prompt)
-        elif self.provider == "openai":
-            return await self._chat_openai(message, system_prompt)
-        elif self.provider == "anthropic":
-            return await self._chat_anthropic(message, system_prompt)
-        else:
-            return f"错误: 不支持的 LLM 提供商: {self.provider}"
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """Shared HTTP client, created on first use so connections are pooled and kept alive"""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                http2=True,
+                timeout=httpx.Timeout(STREAM_TIMEOUT),
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+            )
+        return self._client
+
+    async def close(self):
+        """Close the shared HTTP client"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
 
     async def chat_stream(
-        self, message: str, system_prompt: Optional[str] = None
+        self, message: str, system_prompt: Optional[str] = None, raise_errors: bool = False
     ) -> AsyncGenerator[str, None]:
         """
         Stream chat responses from the LLM.
@@ -55,267 +110,151 @@ class LLMService:
         Args:
             message: User message
             system_prompt: Optional system prompt
+            raise_errors: Raise LLMError on failure instead of yielding the
+                error message as a final token
 
         Yields:
             Response tokens as they arrive
         """
-        if not self.provider:
-            yield "错误: 未配置 LLM 提供商。"
-            return
-
-        if self.provider == "github":
-            async for token in self._stream_github(message, system_prompt):
-                yield token
-        elif self.provider == "openai":
-            async for token in self._stream_openai(message, system_prompt):
-                yield token
-        elif self.provider == "anthropic":
-            async for token in self._stream_anthropic(message, system_prompt):
-                yield token
-        else:
-            yield f"错误: 不支持的 LLM 提供商: {self.provider}"
-
-    async def _chat_github(self, message: str, system_prompt: Optional[str] = None) -> str:
-        """Chat using GitHub Models API (OpenAI-compatible)"""
-        base_url = self.config.get("base_url", "https://models.inference.ai.azure.com")
-        model = self.config.get("model", "gpt-4o")
-        api_key = self.config.get("api_key")
-
-        messages = []
-        if system_prompt:
-            messages.append({"role": "system", "content": system_prompt})
-        messages.append({"role": "user", "content": message})
-
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            try:
-                response = await client.post(
-                    f"{base_url}/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {api_key}",
-                        "Content-Type": "application/json",
-                    },
-                    json={
-                        "model": model,
-                        "messages": messages,
-                        "temperature": 0.7,
-                        "max_tokens": 2048,
-                    },
-                )
-                response.raise_for_status()
-                data = response.json()
-                return data["choices"][0]["message"]["content"]
-            except httpx.HTTPStatusError as e:
-                logger.error(f"GitHub Models API error: {e.response.status_code} - {e.response.text}")
-                return f"API 错误: {e.response.status_code}"
-            except Exception as e:
-                logger.error(f"GitHub Models error: {e}")
-                return f"错误: {str(e)}"
+        try:
+            if not self.provider:
+                raise LLMError("错误: 未配置 LLM 提供商。")
+
+            if self.provider == "github":
+                stream = self._stream_github(message, system_prompt)
+            elif self.provider == "openai":
+                stream = self._stream_openai(message, system_prompt)
+            elif self.provider == "anthropic":
+                stream = self._stream_anthropic(message, system_prompt)
+            else:
+                raise LLMError(f"错误: 不支持的 LLM 提供商: {self.provider}")
+
+            # Close the provider stream (and its HTTP response) as soon as this
+            # generator is closed, not when it is garbage collected
+            async with aclosing(stream):
+                async for token in stream:
+                    yield token
+        except LLMError as e:
+            if raise_errors:
+                raise
+            yield str(e)
 
     async def _stream_github(
         self, message: str, system_prompt: Optional[str] = None
     ) -> AsyncGenerator[str, None]:
         """Stream responses from GitHub Models API"""
-        base_url = self.config.get("base_url", "https://models.inference.ai.azure.com")
-        model = self.config.get("model", "gpt-4o")
-        api_key = self.config.get("api_key")
-
         messages = []
         if system_prompt:
             messages.append({"role": "system", "content": system_prompt})
         messages.append({"role": "user", "content": message})
 
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            try:
-                async with client.stream(
-                    "POST",
-                    f"{base_url}/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {api_key}",
-                        "Content-Type": "application/json",
-                    },
-                    json={
-                        "model": model,
-                        "messages": messages,
-                        "temperature": 0.7,
-                        "max_tokens": 2048,
-                        "stream": True,
-                    },
-                ) as response:
-                    response.raise_for_status()
-                    async for line in response.aiter_lines():
-                        if line.startswith("data: "):
-                            data_str = line[6:]
-                            if data_str.strip() == "[DONE]":
-                                break
-                            try:
-                                data = json.loads(data_str)
-                                delta = data.get("choices", [{}])[0].get("delta", {})
-                                content = delta.get("content", "")
-                                if content:
-                                    yield content
-                            except json.JSONDecodeError:
-                                continue
-            except httpx.HTTPStatusError as e:
-                logger.error(f"GitHub Models stream error: {e.response.status_code}")
-                yield f"API 错误: {e.response.status_code}"
-            except Exception as e:
-                logger.error(f"GitHub Models stream error: {e}")
-                yield f"错误: {str(e)}"
-
-    async def _chat_openai(self, message: str, system_prompt: Optional[str] = None) -> str:
-        """Chat using OpenAI API"""
-        api_key = self.config.get("api_key")
-        model = self.config.get("model", "gpt-4o")
-
-        messages = []
-        if system_prompt:
-            messages.append({"role": "system", "content": system_prompt})
-        messages.append({"role": "user", "content": message})
-
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            try:
-                response = await client.post(
-                    "https://api.openai.com/v1/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {api_key}",
-                        "Content-Type": "application/json",
-                    },
-                    json={
-                        "model": model,
-                        "messages": messages,
-                        "temperature": 0.7,
-                        "max_tokens": 2048,
-                    },
-                )
+        try:
+            async with self.client.stream(
+                "POST",
+                f"{self.base_url}/chat/completions",
+                timeout=STREAM_TIMEOUT,
+                headers=self._headers,
+                content=orjson.dumps({
+                    "model": self.model,
+                    "messages": messages,
+                    "temperature": 0.7,
+                    "max_tokens": 2048,
+                    "stream": True,
+                }),
+            ) as response:
                 response.raise_for_status()
-                data = response.json()
-                return data["choices"][0]["message"]["content"]
-            except Exception as e:
-                logger.error(f"OpenAI API error: {e}")
-                return f"错误: {str(e)}"
+                async for data_str in _iter_sse_data(response):
+                    if data_str.strip() == "[DONE]":
+                        break
+                    try:
+                        data = orjson.loads(data_str)
+                        delta = data.get("choices", [{}])[0].get("delta", {})
+                        content = delta.get("content", "")
+                        if content:
+                            yield content
+                    except orjson.JSONDecodeError:
+                        continue
+        except httpx.HTTPStatusError as e:
+            logger.error("GitHub Models stream error: %s", e.response.status_code)
+            raise LLMError(f"API 错误: {e.response.status_code}") from e
+        except Exception as e:
+            logger.error("GitHub Models stream error: %s", e)
+            raise LLMError(f"错误: {str(e)}") from e
 
     async def _stream_openai(
         self, message: str, system_prompt: Optional[str] = None
     ) -> AsyncGenerator[str, None]:
         """Stream responses from OpenAI API"""
-        api_key = self.config.get("api_key")
-        model = self.config.get("model", "gpt-4o")
-
         messages = []
         if system_prompt:
             messages.append({"role": "system", "content": system_prompt})
         messages.append({"role": "user", "content": message})
 
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            try:
-                async with client.stream(
-                    "POST",
-                    "https://api.openai.com/v1/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {api_key}",
-                        "Content-Type": "application/json",
-                    },
-                    json={
-                        "model": model,
-                        "messages": messages,
-                        "temperature": 0.7,
-                        "max_tokens": 2048,
-                        "stream": True,
-                    },
-                ) as response:
-                    response.raise_for_status()
-                    async for line in response.aiter_lines():
-                        if line.startswith("data: "):
-                            data_str = line[6:]
-                            if data_str.strip() == "[DONE]":
-                                break
-                            try:
-                                data = json.loads(data_str)
-                                delta = data.get("choices", [{}])[0].get("delta", {})
-                                content = delta.get("content", "")
-                                if content:
-                                    yield content
-                            except json.JSONDecodeError:
-                                continue
-            except Exception as e:
-                logger.error(f"OpenAI stream error: {e}")
-                yield f"错误: {str(e)}"
-
-    async def _chat_anthropic(self, message: str, system_prompt: Optional[str] = None) -> str:
-        """Chat using Anthropic API"""
-        api_key = self.config.get("api_key")
-        model = self.config.get("model", "claude-sonnet-4-20250514")
-
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            try:
-                body = {
-                    "model": model,
+        try:
+            async with self.client.stream(
+                "POST",
+                "https://api.openai.com/v1/chat/completions",
+                timeout=STREAM_TIMEOUT,
+                headers=self._headers,
+                content=orjson.dumps({
+                    "model": self.model,
+                    "messages": messages,
+                    "temperature": 0.7,
                     "max_tokens": 2048,
-                    "messages": [{"role": "user", "content": message}],
-                }
-                if system_prompt:
-                    body["system"] = system_prompt
-
-                response = await client.post(
-                    "https://api.anthropic.com/v1/messages",
-                    headers={
-                        "x-api-key": api_key,
-                        "anthropic-version": "2023-06-01",
-                        "Content-Type": "application/json",
-                    },
-                    json=body,
-                )
+                    "stream": True,
+                }),
+            ) as response:
                 response.raise_for_status()
-                data = response.json()
-                return data["content"][0]["text"]
-            except Exception as e:
-                logger.error(f"Anthropic API error: {e}")
-                return f"错误: {str(e)}"
+                async for data_str in _iter_sse_data(response):
+                    if data_str.strip() == "[DONE]":
+                        break
+                    try:
+                        data = orjson.loads(data_str)
+                        delta = data.get("choices", [{}])[0].get("delta", {})
+                        content = delta.get("content", "")
+                        if content:
+                            yield content
+                    except orjson.JSONDecodeError:
+                        continue
+        except Exception as e:
+            logger.error("OpenAI stream error: %s", e)
+            raise LLMError(f"错误: {str(e)}") from e
 
     async def _stream_anthropic(
         self, message: str, system_prompt: Optional[str] = None
     ) -> AsyncGenerator[str, None]:
         """Stream responses from Anthropic API"""
-        api_key = self.config.get("api_key")
-        model = self.config.get("model", "claude-sonnet-4-20250514")
-
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            try:
-                body = {
-                    "model": model,
-                    "max_tokens": 2048,
-                    "messages": [{"role": "user", "content": message}],
-                    "stream": True,
-                }
-                if system_prompt:
-                    body["system"] = system_prompt
-
-                async with client.stream(
-                    "POST",
-                    "https://api.anthropic.com/v1/messages",
-                    headers={
-                        "x-api-key": api_key,
-                        "anthropic-version": "2023-06-01",
-                        "Content-Type": "application/json",
-                    },
-                    json=body,
-                ) as response:
-                    response.raise_for_status()
-                    async for line in response.aiter_lines():
-                        if line.startswith("data: "):
-                            data_str = line[6:]
-                            try:
-                                data = json.loads(data_str)
-                                if data.get("type") == "content_block_delta":
-                                    delta = data.get("delta", {})
-                                    text = delta.get("text", "")
-                                    if text:
-                                        yield text
-                            except json.JSONDecodeError:
-                                continue
-            except Exception as e:
-                logger.error(f"Anthropic stream error: {e}")
-                yield f"错误: {str(e)}"
+        try:
+            body = {
+                "model": self.model,
+                "max_tokens": 2048,
+                "messages": [{"role": "user", "content": message}],
+                "stream": True,
+            }
+            if system_prompt:
+                body["system"] = _anthropic_system(system_prompt)
+
+            async with self.client.stream(
+                "POST",
+                "https://api.anthropic.com/v1/messages",
+                timeout=STREAM_TIMEOUT,
+                headers=self._headers,
+                content=orjson.dumps(body),
+            ) as response:
+                response.raise_for_status()
+                async for data_str in _iter_sse_data(response):
+                    try:
+                        data = orjson.loads(data_str)
+                        if data.get("type") == "content_block_delta":
+                            delta = data.get("delta", {})
+                            text = delta.get("text", "")
+                            if text:
+                                yield text
+                    except orjson.JSONDecodeError:
+                        continue
+        except Exception as e:
+            logger.error("Anthropic stream error: %s", e)
+            raise LLMError(f"错误: {str(e)}") from e
 
 
 # Global LLM service instance
@@ -2,17 +2,20 @@
 Spatial Query Service - Natural language to SQL conversion and execution
 """
 
+import asyncio
+import hashlib
 import json
 import logging
 import re
 import time
-from typing import Any, Optional
-from datetime import datetime, timedelta
+from contextlib import aclosing
+from typing import Any, Literal, Optional
 
 import asyncpg
 
-from app.config import settings
-from app.services.llm import llm_service
+from app.config import get_settings
+from app.services.llm import LLMError, llm_service
+from app.services.sql_cache import SemanticCache
 
 logger = logging.getLogger(__name__)
 
@@ -105,22 +108,146 @@ SQL: SELECT drone_id, COUNT(*) as point_count, AVG(speed) as avg_speed, AVG(alti
 现在请根据用户的查询生成 SQL：
 """
 
+# The static schema prompt goes in the system prompt, ahead of the per-query
+# message, so providers can cache it as a prompt prefix
+SQL_SYSTEM_PROMPT = f"你是一个 SQL 生成器。只输出纯 SQL 语句，不要有任何其他文字。\n\n{SQL_GENERATION_PROMPT}"
+
+
+# Stock SQL for the most common queries, answered without calling the LLM.
+# Patterns must match the whole normalized query (see _normalize_template_query),
+# so a query with any extra filter or condition still goes to the LLM.
+SQL_TEMPLATES: list[tuple[re.Pattern, str]] = [
+    (
+        re.compile(r"(?:查询|显示|列出)?所有在线的?无人机|(?:show|list) (?:all )?online drones"),
+        "SELECT device_id, device_type, status, ST_X(location) as longitude, ST_Y(location) as latitude, "
+        "battery_level, last_seen FROM device_status WHERE device_type = 'quadcopter' AND status != 'offline' "
+        "ORDER BY last_seen DESC",
+    ),
+    (
+        re.compile(r"(?:查询|显示)?(?:过去|最近)24小时的?(?:所有)?无人机轨迹(?:数据)?"),
+        "SELECT drone_id, ST_X(location) as longitude, ST_Y(location) as latitude, altitude, speed, timestamp "
+        "FROM drone_trajectory WHERE timestamp > NOW() - INTERVAL '24 hours' ORDER BY timestamp DESC",
+    ),
+    (
+        re.compile(r"统计每架无人机的平均速度"),
+        "SELECT drone_id, COUNT(*) as point_count, AVG(speed) as avg_speed, AVG(altitude) as avg_altitude "
+        "FROM drone_trajectory WHERE timestamp > NOW() - INTERVAL '24 hours' GROUP BY drone_id "
+        "ORDER BY avg_speed DESC",
+    ),
+    (
+        re.compile(r"所有无人机的轨迹数据"),
+        "SELECT drone_id, ST_X(location) as longitude, ST_Y(location) as latitude, altitude, speed, heading, "
+        "timestamp FROM drone_trajectory ORDER BY timestamp DESC",
+    ),
+    (
+        re.compile(r"统计所有无人机的轨迹点数量、平均速度、平均高度和总距离"),
+        "SELECT drone_id, COUNT(*) as point_count, AVG(speed) as avg_speed, AVG(altitude) as avg_altitude, "
+        "ST_Length(ST_MakeLine(location ORDER BY timestamp)::geography) as total_distance_m "
+        "FROM drone_trajectory GROUP BY drone_id ORDER BY drone_id",
+    ),
+    (
+        re.compile(r"查询所有地理围栏|(?:show|list) (?:all )?geofences"),
+        "SELECT id, name, description, fence_type, is_active, ST_AsGeoJSON(boundary) as boundary, "
+        "created_at, updated_at FROM geo_fence ORDER BY id",
+    ),
+    (
+        re.compile(r"查询所有设备的状态和位置"),
+        "SELECT device_id, device_type, status, ST_X(location) as longitude, ST_Y(location) as latitude, "
+        "battery_level, last_seen FROM device_status ORDER BY last_seen DESC",
+    ),
+]
+
+_TEMPLATE_TRAILING_RE = re.compile(r"[\s。.？?！!]+$")
+_TEMPLATE_SPACE_RE = re.compile(r"\s+")
+
+
+def _normalize_template_query(query: str) -> str:
+    """Lowercase, collapse whitespace and drop trailing punctuation"""
+    return _TEMPLATE_SPACE_RE.sub(" ", _TEMPLATE_TRAILING_RE.sub("", query.strip().lower()))
+
+
+def match_sql_template(natural_query: str) -> Optional[str]:
+    """Get stock SQL for a query that exactly matches a common intent"""
+    normalized = _normalize_template_query(natural_query)
+    for pattern, sql in SQL_TEMPLATES:
+        if pattern.fullmatch(normalized):
+            return sql
+    return None
+
+
+# Query results as a list of row dicts, or as a dict of column lists
+ResultLayout = Literal["rows", "columns"]
+
+# Cache keys include the schema version so schema edits invalidate cached SQL
+SCHEMA_VERSION = hashlib.sha256(DATABASE_SCHEMA.encode()).hexdigest()[:12]
+
+# Maximum entries in the natural language -> SQL cache
+SQL_CACHE_SIZE = 1024
+
+# Postgres column types whose values are returned as ISO strings
+_TIMESTAMP_TYPES = frozenset({"timestamptz", "timestamp"})
+
+# Seconds that database statistics are served from cache
+STATS_CACHE_TTL = 30.0
+
+
+def _row_count(results: list[dict] | dict[str, list]) -> int:
+    """Number of rows in a row- or column-oriented result"""
+    if isinstance(results, dict):
+        return len(next(iter(results.values()), []))
+    return len(results)
+
 
 class SpatialQueryService:
     """Service for spatial queries using natural language"""
 
+    _FORBIDDEN_STATEMENTS = frozenset({
+        "INSERT", "UPDATE", "DELETE", "DROP", "TRUNCATE",
+        "ALTER", "CREATE", "GRANT", "REVOKE", "EXECUTE",
+        "COPY", "VACUUM", "REINDEX",
+    })
+    _INJECTION_SQL = re.compile(
+        r";\s*--"  # Comment after semicolon
+        r"|'\s*OR\s+'1'\s*=\s*'1"  # OR 1=1
+        r'|"\s*OR\s+"1"\s*=\s*"1'
+        r"|UNION\s+SELECT",  # UNION injection
+        re.IGNORECASE,
+    )
+
+    _SQL_FENCE = re.compile(r"^\s*```[^\n]*\n(.*?)(?:```)?\s*$", re.DOTALL)
+    _SQL_PREFIX = re.compile(r"^\s*sql\b\s*:?", re.IGNORECASE)
+    _LIMIT_SQL = re.compile(r"\bLIMIT\b", re.IGNORECASE)
+    _WORD_BREAK = re.compile(r"[\s;]")
+
     def __init__(self):
         self._pool: Optional[asyncpg.Pool] = None
+        self._stats_cache: Optional[tuple[float, dict]] = None
+        self._sql_cache = SemanticCache(
+            max_entries=SQL_CACHE_SIZE,
+            version=SCHEMA_VERSION,
+            near_match=get_settings().SQL_CACHE_NEAR_MATCH,
+        )
 
     async def get_pool(self) -> asyncpg.Pool:
         """Get or create database connection pool"""
         if self._pool is None:
+            settings = get_settings()
+
             # Convert SQLAlchemy URL to asyncpg format
             db_url = settings.DATABASE_URL
             if db_url.startswith("postgresql+asyncpg://"):
                 db_url = db_url.replace("postgresql+asyncpg://", "postgresql://")
 
-            self._pool = await asyncpg.create_pool(db_url, min_size=2, max_size=10)
+            self._pool = await asyncpg.create_pool(
+                db_url,
+                min_size=settings.DB_POOL_MIN_SIZE,
+                max_size=settings.DB_POOL_MAX_SIZE,
+                statement_cache_size=settings.DB_STATEMENT_CACHE_SIZE,
+                max_inactive_connection_lifetime=300,
+                command_timeout=settings.DB_COMMAND_TIMEOUT,
+                # Postgres JIT compilation costs more than it saves on short queries
+                server_settings={"jit": "off"},
+            )
         return self._pool
 
     async def close(self):
@@ -138,27 +265,71 @@ class SpatialQueryService:
 
         Returns:
             Generated SQL query
-        """
-        prompt = f"{SQL_GENERATION_PROMPT}\n\n用户查询: {natural_query}\nSQL:"
 
-        response = await llm_service.chat(
-            message=prompt,
-            system_prompt="你是一个 SQL 生成器。只输出纯 SQL 语句，不要有任何其他文字。",
+        Raises:
+            LLMError: If the LLM request fails
+        """
+        # Common intents are answered from stock SQL without the LLM
+        template_sql = match_sql_template(natural_query)
+        if template_sql is not None:
+            return template_sql
+
+        # Repeated or paraphrased queries reuse SQL that already ran successfully
+        cached_sql = self._sql_cache.get(natural_query)
+        if cached_sql is not None:
+            logger.info("SQL cache hit for: %s", natural_query)
+            return cached_sql
+
+        # Stream the response so generation stops as soon as a statement's first
+        # word is a data-modifying one; validate_sql rejects the result later.
+        # Only the first word of each statement matters, so the partial SQL is
+        # checked on word breaks until that word is complete, and again after
+        # every ";"
+        chunks: list[str] = []
+        check_pending = True
+        stream = llm_service.chat_stream(
+            message=f"用户查询: {natural_query}\nSQL:",
+            system_prompt=SQL_SYSTEM_PROMPT,
+            raise_errors=True,
         )
-
-        # Clean up the response
-        sql = response.strip()
-
-        # Remove markdown code blocks if present
-        if sql.startswith("```"):
-            lines = sql.split("\n")
-            sql = "\n".join(lines[1:-1] if lines[-1] == "```" else lines[1:])
-
-        # Remove sql prefix
-        if sql.lower().startswith("sql"):
-            sql = sql[3:].strip()
-
-        return sql.strip()
+        async with aclosing(stream):
+            async for token in stream:
+                chunks.append(token)
+                check_pending = check_pending or ";" in token
+                if not check_pending or not self._WORD_BREAK.search(token):
+                    continue
+
+                text = "".join(chunks)
+                sql = self._clean_sql_response(text)
+                if self._find_forbidden_statement(sql):
+                    logger.warning("Aborted SQL generation for: %s", natural_query)
+                    break
+
+                statement = sql.rsplit(";", 1)[-1]
+                words = statement.split(None, 1)
+                check_pending = not (len(words) == 2 or (words and text[-1].isspace()))
+
+        return self._clean_sql_response("".join(chunks))
+
+    @classmethod
+    def _clean_sql_response(cls, response: str) -> str:
+        """Unwrap a markdown code block and drop an "SQL:" prefix from an LLM response"""
+        match = cls._SQL_FENCE.match(response)
+        sql = match.group(1) if match else response
+        return cls._SQL_PREFIX.sub("", sql, count=1).strip()
+
+    def _remember_sql(self, natural_query: str, sql: str) -> None:
+        """Cache SQL that executed successfully for a natural language query"""
+        self._sql_cache.add(natural_query, sql)
+
+    @classmethod
+    def _find_forbidden_statement(cls, sql: str) -> Optional[str]:
+        """Get the first statement keyword in the SQL that is not allowed, if any"""
+        for statement in sql.split(";"):
+            words = statement.split(None, 1)
+            if words and words[0].upper() in cls._FORBIDDEN_STATEMENTS:
+                return words[0].upper()
+        return None
 
     def validate_sql(self, sql: str) -> tuple[bool, str]:
         """
@@ -167,80 +338,122 @@ class SpatialQueryService:
         Returns:
             (is_valid, error_message)
         """
-        sql_upper = sql.upper().strip()
-
-        # Check for dangerous keywords
-        dangerous_keywords = [
-            "INSERT", "UPDATE", "DELETE", "DROP", "TRUNCATE",
-            "ALTER", "CREATE", "GRANT", "REVOKE", "EXECUTE",
-            "COPY", "VACUUM", "REINDEX"
-        ]
-
-        for keyword in dangerous_keywords:
-            # Check if keyword is at the start or after a semicolon
-            if sql_upper.startswith(keyword) or f"; {keyword}" in sql_upper:
-                return False, f"不允许的操作: {keyword}"
+        # Check for dangerous statements
+        keyword = self._find_forbidden_statement(sql)
+        if keyword:
+            return False, f"不允许的操作: {keyword}"
 
         # Check for SQL injection patterns
-        injection_patterns = [
-            r";\s*--",  # Comment after semicolon
-            r"'\s*OR\s+'1'\s*=\s*'1",  # OR 1=1
-            r'"\s*OR\s+"1"\s*=\s*"1',
-            r"UNION\s+SELECT",  # UNION injection
-        ]
-
-        for pattern in injection_patterns:
-            if re.search(pattern, sql, re.IGNORECASE):
-                return False, f"检测到潜在的 SQL 注入模式"
-
-        # Must start with SELECT
-        if not sql_upper.startswith("SELECT"):
+        if self._INJECTION_SQL.search(sql):
+            return False, "检测到潜在的 SQL 注入模式"
+
+        # Must start with SELECT (only the first word is case-folded)
+        stripped = sql.lstrip()
+        if stripped[:6].upper() != "SELECT" or (len(stripped) > 6 and not stripped[6].isspace()):
             return False, "只允许 SELECT 查询"
 
         return True, ""
 
     async def execute_query(
-        self, sql: str, max_rows: int = 100
-    ) -> tuple[list[dict], float]:
+        self,
+        sql: str,
+        max_rows: int = 100,
+        params: tuple = (),
+        layout: ResultLayout = "rows",
+        conn: Optional[asyncpg.Connection] = None,
+    ) -> tuple[list[dict] | dict[str, list], float]:
         """
         Execute SQL query and return results.
 
         Args:
             sql: SQL query to execute
             max_rows: Maximum rows to return
+            params: Values for $1, $2, ... placeholders in the query
+            layout: "rows" for a list of row dicts, "columns" for a dict of
+                column name -> list of values (fewer objects for large results)
+            conn: Connection to run on; one is checked out of the pool if omitted
 
         Returns:
             (results, execution_time_ms)
         """
-        # Add LIMIT if not present
-        if "LIMIT" not in sql.upper():
-            sql = f"{sql.rstrip(';')} LIMIT {max_rows}"
+        # Add LIMIT if not present, as a bound parameter so the statement text
+        # (and asyncpg's cached prepared statement) is the same for any max_rows.
+        # The query goes on its own lines so a trailing "-- comment" cannot
+        # swallow the closing parenthesis
+        if not self._LIMIT_SQL.search(sql):
+            inner = sql.rstrip().rstrip(";")
+            sql = f"SELECT * FROM (\n{inner}\n) AS limited LIMIT ${len(params) + 1}"
+            params = (*params, max_rows)
+
+        if conn is not None:
+            return await self._fetch(conn, sql, params, layout)
 
         pool = await self.get_pool()
+        async with pool.acquire() as conn:
+            return await self._fetch(conn, sql, params, layout)
+
+    @staticmethod
+    async def _fetch(
+        conn: asyncpg.Connection, sql: str, params: tuple, layout: ResultLayout
+    ) -> tuple[list[dict] | dict[str, list], float]:
+        """Run a query on a connection and convert the rows to the requested layout"""
         start_time = time.time()
 
         try:
-            async with pool.acquire() as conn:
-                rows = await conn.fetch(sql)
-                execution_time = (time.time() - start_time) * 1000  # ms
-
-                # Convert rows to dicts
+            statement = await conn.prepare(sql)
+            rows = await statement.fetch(*params)
+            execution_time = (time.time() - start_time) * 1000  # ms
+
+            # Timestamps are returned as ISO strings ("2024-01-01T00:00:00+00:00").
+            # The column types say which columns hold them, so only those
+            # values are converted
+            timestamp_columns = [
+                attribute.name
+                for attribute in statement.get_attributes()
+                if attribute.type.name in _TIMESTAMP_TYPES
+            ] if rows else []
+
+            # Convert rows to dicts (or columns)
+            if layout == "columns":
+                columns = list(rows[0].keys()) if rows else []
+                results = {col: [row[i] for row in rows] for i, col in enumerate(columns)}
+                for col in timestamp_columns:
+                    results[col] = [None if value is None else value.isoformat() for value in results[col]]
+            else:
                 results = [dict(row) for row in rows]
-
-                # Convert datetime objects to strings
                 for row in results:
-                    for key, value in row.items():
-                        if isinstance(value, datetime):
-                            row[key] = value.isoformat()
+                    for col in timestamp_columns:
+                        if row[col] is not None:
+                            row[col] = row[col].isoformat()
 
-                return results, execution_time
+            return results, execution_time
 
         except asyncpg.PostgresError as e:
-            logger.error(f"Database error: {e}")
+            logger.error("Database error: %s", e)
             raise Exception(f"数据库错误: {str(e)}")
 
+    async def _acquire(self) -> asyncpg.Connection:
+        """Check out a pooled connection (release it with self._pool.release)"""
+        pool = await self.get_pool()
+        return await pool.acquire()
+
+    async def _discard_acquire(self, acquire: asyncio.Task) -> None:
+        """Cancel a pending connection checkout, releasing the connection if it already completed"""
+        acquire.cancel()
+        try:
+            conn = await acquire
+        except asyncio.CancelledError:
+            # Only the cancellation requested above is expected; if the caller
+            # itself was cancelled while waiting, let that propagate
+            if not acquire.cancelled() or asyncio.current_task().cancelling():
+                raise
+            return
+        except Exception:
+            return
+        await self._pool.release(conn)
+
     async def query_natural_language(
-        self, query: str, max_rows: int = 100
+        self, query: str, max_rows: int = 100, layout: ResultLayout = "rows"
     ) -> dict[str, Any]:
         """
         Execute a natural language spatial query.
@@ -248,18 +461,35 @@ class SpatialQueryService:
         Args:
             query: Natural language query
             max_rows: Maximum rows to return
+            layout: Result layout, see execute_query
 
         Returns:
             Query result with SQL, data, and metadata
         """
         # Generate SQL from natural language
-        logger.info(f"Generating SQL for: {query}")
-        sql = await self.generate_sql(query)
-        logger.info(f"Generated SQL: {sql}")
+        logger.info("Generating SQL for: %s", query)
+        try:
+            sql = await self.generate_sql(query)
+        except LLMError as e:
+            return {
+                "success": False,
+                "error": str(e),
+                "sql": "",
+                "data": [],
+                "row_count": 0,
+                "execution_time_ms": 0,
+            }
+        logger.info("Generated SQL: %s", sql)
+
+        # Start checking out a connection before validating; yielding once lets the
+        # checkout begin (and queue on a busy pool) while the SQL is validated
+        acquire = asyncio.create_task(self._acquire())
+        await asyncio.sleep(0)
 
         # Validate SQL
         is_valid, error = self.validate_sql(sql)
         if not is_valid:
+            await self._discard_acquire(acquire)
             return {
                 "success": False,
                 "error": error,
@@ -271,12 +501,19 @@ class SpatialQueryService:
 
         # Execute query
         try:
-            results, execution_time = await self.execute_query(sql, max_rows)
+            conn = await acquire
+            try:
+                results, execution_time = await self.execute_query(
+                    sql, max_rows, layout=layout, conn=conn
+                )
+            finally:
+                await self._pool.release(conn)
+            self._remember_sql(query, sql)
             return {
                 "success": True,
                 "sql": sql,
                 "data": results,
-                "row_count": len(results),
+                "row_count": _row_count(results),
                 "execution_time_ms": round(execution_time, 2),
             }
         except Exception as e:
@@ -290,30 +527,32 @@ class SpatialQueryService:
             }
 
     async def get_database_stats(self) -> dict:
-        """Get database statistics"""
+        """Get database statistics (cached for STATS_CACHE_TTL seconds)"""
+        now = time.monotonic()
+        if self._stats_cache is not None and now - self._stats_cache[0] < STATS_CACHE_TTL:
+            return self._stats_cache[1]
+
         pool = await self.get_pool()
 
         try:
-            async with pool.acquire() as conn:
-                # Get table counts
-                trajectory_count = await conn.fetchval(
-                    "SELECT COUNT(*) FROM drone_trajectory"
-                )
-                device_count = await conn.fetchval(
-                    "SELECT COUNT(*) FROM device_status"
-                )
-                fence_count = await conn.fetchval(
-                    "SELECT COUNT(*) FROM geo_fence"
-                )
-
-                return {
-                    "tables": {
-                        "drone_trajectory": trajectory_count,
-                        "device_status": device_count,
-                        "geo_fence": fence_count,
-                    },
-                    "status": "connected",
-                }
+            # Get table counts concurrently, each on its own pooled connection
+            trajectory_count, device_count, fence_count = await asyncio.gather(
+                pool.fetchval("SELECT COUNT(*) FROM drone_trajectory"),
+                pool.fetchval("SELECT COUNT(*) FROM device_status"),
+                pool.fetchval("SELECT COUNT(*) FROM geo_fence"),
+            )
+
+            stats = {
+                "tables": {
+                    "drone_trajectory": trajectory_count,
+                    "device_status": device_count,
+                    "geo_fence": fence_count,
+                },
+                "status": "connected",
+            }
+            # Only successful lookups are cached so errors recover on the next call
+            self._stats_cache = (now, stats)
+            return stats
         except Exception as e:
             return {
                 "tables": {},
@@ -0,0 +1,147 @@
+"""
+SQL Cache - Reuse generated SQL for repeated or paraphrased queries
+"""
+
+import math
+import re
+from collections import Counter, OrderedDict
+from typing import Optional
+
+# Parts of a query that change the meaning of the SQL even when the wording is
+# otherwise nearly identical. A near match is only used when the signature
+# (every occurrence of these, in order) is the same for both queries, so
+# bigram similarity only absorbs differences in filler wording.
+_SIGNATURE_TERMS = (
+    # Negation
+    "不", "非", "没", "未", "除",
+    # Comparison, ordering and extremes
+    "大于", "小于", "等于", "高于", "低于", "超过", "不足", "以上", "以下", "以内", "以外",
+    "之内", "之外", "之前", "之后", "以前", "以后", "之间", "附近",
+    "升序", "降序", "正序", "倒序", "逆序", "从高到低", "从低到高", "从大到小", "从小到大",
+    "从早到晚", "从晚到早", "从近到远", "从远到近",
+    "最大", "最小", "最高", "最低", "最多", "最少", "最快", "最慢", "最近", "最远",
+    "最早", "最晚", "最新", "最旧", "最长", "最短",
+    # Aggregates
+    "平均", "总", "数量", "个数", "次数", "计数", "求和", "中位",
+    # Status and type values
+    "在线", "离线", "上线", "下线", "空闲", "飞行", "起飞", "降落", "悬停", "充电", "故障",
+    "正常", "异常", "完成", "失败", "成功", "进行", "取消", "启用", "禁用", "停用", "激活",
+    "禁飞", "告警", "警戒", "警报", "巡逻", "四旋翼", "地面", "机器人",
+    # Tables and columns
+    "无人机", "设备", "围栏", "任务", "日志", "轨迹", "速度", "高度", "海拔", "航向", "方向",
+    "电量", "电池", "位置", "坐标", "经度", "纬度", "距离", "面积", "长度", "时间", "状态",
+    "类型", "名称", "描述", "边界", "动作", "错误",
+    # Time and distance units
+    "今天", "昨天", "前天", "本周", "上周", "本月", "上月", "今年", "去年",
+    "秒", "分钟", "小时", "天", "日", "周", "星期", "月", "年", "公里", "千米", "米",
+)
+_SIGNATURE_RE = re.compile(
+    r"'[^']*'|\"[^\"]*\""  # Quoted literals
+    r"|[a-z0-9_\-]+(?:\.[0-9]+)*"  # Every ASCII word, number and identifier ("no_fly", "drone-001")
+    r"|!=|<>|[<>]=?|="
+    + "".join(f"|{re.escape(term)}" for term in sorted(_SIGNATURE_TERMS, key=len, reverse=True)),
+    re.IGNORECASE,
+)
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def _normalize(query: str) -> str:
+    """
+    Collapse whitespace.
+
+    Case is kept: identifiers and quoted values in the query end up as string
+    literals in the SQL, and Postgres compares those case-sensitively.
+    """
+    return _WHITESPACE_RE.sub(" ", query.strip())
+
+
+def _signature(text: str) -> tuple[str, ...]:
+    """Meaning-bearing terms of normalized text, in order, with their case kept"""
+    return tuple(_SIGNATURE_RE.findall(text))
+
+
+def _embed(text: str) -> tuple[Counter, float]:
+    """
+    Embed text as a character-bigram count vector.
+
+    Bigrams work for Chinese (no word boundaries) as well as English and need
+    no embedding model. Returns the sparse vector and its L2 norm.
+    """
+    compact = text.replace(" ", "")
+    vector = Counter(compact[i:i + 2] for i in range(len(compact) - 1)) or Counter([compact])
+    return vector, math.sqrt(sum(count * count for count in vector.values()))
+
+
+class SemanticCache:
+    """
+    Similarity cache from natural language queries to SQL.
+
+    A lookup returns the SQL cached for the same normalized query. With
+    `near_match` enabled it otherwise returns the SQL of the most similar
+    cached query when its cosine similarity reaches `threshold` and its
+    signature (literal values, every ASCII word and the Chinese terms that
+    carry meaning) matches exactly. Near matching is off by default: bigram
+    similarity cannot tell apart long queries that differ only in a place
+    name or a Chinese numeral, so it can return SQL for another question.
+    Entries are evicted least-recently-used once `max_entries` is reached.
+    Exact keys include `version`, so SQL cached for one schema version is
+    never returned for another.
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.92,
+        max_entries: int = 512,
+        version: str = "",
+        near_match: bool = False,
+    ):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.version = version
+        self.near_match = near_match
+        # "version|normalized query" -> (signature, vector, norm, sql)
+        self._entries: OrderedDict[str, tuple[tuple[str, ...], Counter, float, str]] = OrderedDict()
+
+    def get(self, query: str) -> Optional[str]:
+        """Get cached SQL for a query, or None on a miss"""
+        text = _normalize(query)
+        key = f"{self.version}|{text}"
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            return entry[3]
+        if not self.near_match:
+            return None
+
+        signature = _signature(text)
+        vector, norm = _embed(text.lower())
+        if not norm:
+            return None
+
+        best_key, best_score = None, self.threshold
+        for cached_key, (cached_signature, cached_vector, cached_norm, _) in self._entries.items():
+            if cached_signature != signature:
+                continue
+            small, large = sorted((vector, cached_vector), key=len)
+            dot = sum(count * large[gram] for gram, count in small.items() if gram in large)
+            score = dot / (norm * cached_norm)
+            if score >= best_score:
+                best_key, best_score = cached_key, score
+
+        if best_key is None:
+            return None
+        self._entries.move_to_end(best_key)
+        return self._entries[best_key][3]
+
+    def add(self, query: str, sql: str) -> None:
+        """Cache the SQL generated for a query"""
+        text = _normalize(query)
+        key = f"{self.version}|{text}"
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return
+
+        vector, norm = _embed(text.lower())
+        self._entries[key] = (_signature(text), vector, norm, sql)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
@@ -2,13 +2,15 @@
 Spatial Agent Backend - FastAPI Application Entry Point
 """
 
-import asyncio
 import logging
 import os
-import signal
 import sys
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
 from pathlib import Path
 
+from fastapi import FastAPI
+
 # Setup logging
 logging.basicConfig(
     level=logging.INFO,
@@ -20,59 +22,58 @@ logger = logging.getLogger("spatial-agent")
 sys.path.insert(0, str(Path(__file__).parent))
 
 from app import create_app
-from app.config import settings
-
-# Create FastAPI application
-app = create_app()
-
-# Graceful shutdown handling
-shutdown_event = asyncio.Event()
-
-
-def signal_handler(signum: int, frame: object) -> None:
-    """Handle shutdown signals"""
-    logger.warning(f"Received shutdown signal: {signum}")
-    shutdown_event.set()
-
+from app.config import get_settings
 
-signal.signal(signal.SIGTERM, signal_handler)
-signal.signal(signal.SIGINT, signal_handler)
 
-
-@app.on_event("startup")
-async def startup_event() -> None:
-    """Application startup handler"""
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """Application startup and shutdown handler"""
+    settings = get_settings()
     logger.info("Starting Spatial Agent Backend")
-    logger.info(f"Environment: {settings.ENVIRONMENT}")
-    logger.info(f"Debug mode: {settings.DEBUG}")
+    logger.info("Environment: %s", settings.ENVIRONMENT)
+    logger.info("Debug mode: %s", settings.DEBUG)
 
     # Write PID file
     pid_file = Path(__file__).parent / "runtime" / "run.pid"
     pid_file.parent.mkdir(parents=True, exist_ok=True)
     pid_file.write_text(str(os.getpid()))
-    logger.info(f"PID file written: {os.getpid()}")
+    logger.info("PID file written: %s", os.getpid())
 
+    yield
 
-@app.on_event("shutdown")
-async def shutdown_event_handler() -> None:
-    """Application shutdown handler"""
     logger.info("Shutting down Spatial Agent Backend")
 
+    # Release pooled HTTP and database connections
+    from app.services.llm import llm_service
+    from app.services.spatial import spatial_service
+
+    await llm_service.close()
+    await spatial_service.close()
+
     # Remove PID file
-    pid_file = Path(__file__).parent / "runtime" / "run.pid"
     if pid_file.exists():
         pid_file.unlink()
 
     logger.info("Shutdown complete")
 
 
+# Create FastAPI application
+app = create_app(lifespan=lifespan)
+
+
 if __name__ == "__main__":
     import uvicorn
 
+    settings = get_settings()
     uvicorn.run(
         "main:app",
         host=settings.HOST,
         port=settings.PORT,
         reload=settings.DEBUG,
+        # Reload mode runs a single process; production scales with workers
+        workers=None if settings.DEBUG else settings.WEB_CONCURRENCY,
+        # uvloop/httptools ship with uvicorn[standard]; uvloop is unavailable on Windows
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
         log_level="info",
     )
@@ -0,0 +1,18 @@
+"""
+Tests for the application factory
+"""
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import create_app
+
+
+@pytest.mark.filterwarnings("error::fastapi.exceptions.FastAPIDeprecationWarning")
+def test_health_check():
+    client = TestClient(create_app())
+
+    response = client.get("/health")
+
+    assert response.status_code == 200
+    assert response.json()["status"] == "healthy"
@@ -0,0 +1,161 @@
+"""
+Tests for SQL handling in the spatial query service
+"""
+
+import asyncio
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+
+from app.services.llm import LLMError, llm_service
+from app.services.spatial import SpatialQueryService
+
+
+class RecordingConnection:
+    """Connection stand-in that records the statements it is asked to run"""
+
+    def __init__(self, rows=(), column_types=None):
+        self.calls: list[tuple[str, tuple]] = []
+        self.rows = list(rows)
+        self.column_types = column_types or {}
+
+    async def prepare(self, sql):
+        return RecordingStatement(self, sql)
+
+
+class RecordingStatement:
+    """Prepared statement stand-in returning the connection's canned rows"""
+
+    def __init__(self, conn, sql):
+        self.conn = conn
+        self.sql = sql
+
+    async def fetch(self, *params):
+        self.conn.calls.append((self.sql, params))
+        return self.conn.rows
+
+    def get_attributes(self):
+        return [
+            SimpleNamespace(name=name, type=SimpleNamespace(name=type_name))
+            for name, type_name in self.conn.column_types.items()
+        ]
+
+
+async def test_limit_wrap_survives_trailing_comment():
+    conn = RecordingConnection()
+    sql = "SELECT device_id FROM device_status -- 在线设备"
+
+    await SpatialQueryService().execute_query(sql, max_rows=10, conn=conn)
+
+    wrapped, params = conn.calls[0]
+    assert wrapped == f"SELECT * FROM (\n{sql}\n) AS limited LIMIT $1"
+    assert params == (10,)
+
+
+
+async def test_timestamps_keep_iso_offset_format():
+    conn = RecordingConnection(
+        rows=[
+            {"device_id": "drone-001", "last_seen": datetime(2024, 1, 1, tzinfo=timezone.utc)},
+            {"device_id": "drone-002", "last_seen": None},
+        ],
+        column_types={"device_id": "varchar", "last_seen": "timestamptz"},
+    )
+
+    results, _ = await SpatialQueryService().execute_query(
+        "SELECT device_id, last_seen FROM device_status", conn=conn
+    )
+
+    assert results == [
+        {"device_id": "drone-001", "last_seen": "2024-01-01T00:00:00+00:00"},
+        {"device_id": "drone-002", "last_seen": None},
+    ]
+
+async def test_llm_stream_error_is_not_sent_as_sql(monkeypatch):
+    async def failing_stream(message, system_prompt=None):
+        yield "SELECT device_id FROM "
+        raise LLMError("错误: connection reset")
+
+    monkeypatch.setattr(llm_service, "provider", "openai")
+    monkeypatch.setattr(llm_service, "_stream_openai", failing_stream)
+
+    result = await SpatialQueryService().query_natural_language("查询离线超过一天的设备")
+
+    assert result["success"] is False
+    assert result["error"] == "错误: connection reset"
+    assert result["sql"] == ""
+
+
+async def _slow_checkout():
+    """Connection checkout that takes a moment to clean up when cancelled"""
+    try:
+        await asyncio.sleep(10)
+    except asyncio.CancelledError:
+        await asyncio.sleep(0.01)
+        raise
+
+
+async def test_discard_acquire_cancels_checkout():
+    acquire = asyncio.create_task(_slow_checkout())
+    await asyncio.sleep(0)
+
+    await SpatialQueryService()._discard_acquire(acquire)
+
+    assert acquire.cancelled()
+
+
+async def test_discard_acquire_propagates_caller_cancellation():
+    acquire = asyncio.create_task(_slow_checkout())
+    await asyncio.sleep(0)
+    caller = asyncio.create_task(SpatialQueryService()._discard_acquire(acquire))
+    await asyncio.sleep(0)
+
+    caller.cancel()
+
+    with pytest.raises(asyncio.CancelledError):
+        await caller
+
+
+async def test_provider_stream_is_closed_before_generate_sql_returns(monkeypatch):
+    closed = []
+
+    async def provider_stream(message, system_prompt=None):
+        try:
+            yield "DELETE"
+            yield " FROM"
+            await asyncio.sleep(10)
+        finally:
+            closed.append(True)
+
+    monkeypatch.setattr(llm_service, "provider", "openai")
+    monkeypatch.setattr(llm_service, "_stream_openai", provider_stream)
+
+    sql = await SpatialQueryService().generate_sql("删除离线设备")
+
+    assert sql.startswith("DELETE")
+    assert closed == [True]
+
+
+@pytest.mark.parametrize(
+    "tokens",
+    [
+        ["DELETE", " FROM", " device_status"],
+        ["```sql\n", "UPD", "ATE", " device_status", " SET"],
+        ["SELECT", " 1", ";", " DROP", " TABLE"],
+    ],
+)
+async def test_generation_stops_at_first_forbidden_word(monkeypatch, tokens):
+    received = []
+
+    async def provider_stream(message, system_prompt=None):
+        for token in tokens:
+            received.append(token)
+            yield token
+
+    monkeypatch.setattr(llm_service, "provider", "openai")
+    monkeypatch.setattr(llm_service, "_stream_openai", provider_stream)
+
+    await SpatialQueryService().generate_sql("修改设备状态")
+
+    assert received == tokens[:-1]
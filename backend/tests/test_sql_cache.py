@@ -0,0 +1,94 @@
+"""
+Tests for the natural language -> SQL cache
+"""
+
+import pytest
+
+from app.services.sql_cache import SemanticCache
+
+
+def test_exact_match_ignores_whitespace():
+    cache = SemanticCache()
+    cache.add("show all  online drones", "SELECT 1")
+
+    assert cache.get("  show all online drones ") == "SELECT 1"
+
+
+@pytest.mark.parametrize("near_match", [False, True])
+def test_literal_case_is_significant(near_match):
+    cache = SemanticCache(near_match=near_match)
+    cache.add("show device drone-001 location", "SELECT 1")
+
+    assert cache.get("show device DRONE-001 location") is None
+
+
+def test_near_match_is_off_by_default():
+    cache = SemanticCache()
+    cache.add("查询所有无人机并按电量降序排列", "SELECT 1")
+
+    assert cache.get("查询所有无人机并按电量降序排列。") is None
+
+
+@pytest.mark.parametrize(
+    ("cached", "query"),
+    [
+        (
+            "查询过去24小时上海区域内飞行高度超过100米的所有无人机轨迹数据并按时间排序",
+            "查询过去24小时北京区域内飞行高度超过100米的所有无人机轨迹数据并按时间排序",
+        ),
+        (
+            "查询所有在线的无人机设备状态和当前位置信息并按电量排序显示前五个",
+            "查询所有在线的无人机设备状态和当前位置信息并按电量排序显示前十个",
+        ),
+    ],
+)
+def test_long_query_differing_in_one_word_is_a_miss(cached, query):
+    cache = SemanticCache()
+    cache.add(cached, "SELECT 1")
+
+    assert cache.get(query) is None
+
+
+def test_near_match_reuses_sql():
+    cache = SemanticCache(near_match=True)
+    cache.add("查询所有无人机并按电量降序排列", "SELECT 1")
+
+    assert cache.get("查询所有无人机并按电量降序排列。") == "SELECT 1"
+
+
+@pytest.mark.parametrize(
+    ("cached", "query"),
+    [
+        ("显示所有在线的无人机", "显示所有离线的无人机"),
+        ("show all online drones", "show all offline drones"),
+        ("查询所有无人机并按电量降序排列", "查询所有无人机并按电量升序排列"),
+        ("list drones by battery level asc", "list drones by battery level desc"),
+        ("查询速度最大的无人机", "查询速度最小的无人机"),
+        ("show the drone with max speed", "show the drone with min speed"),
+        ("show geofences of type no_fly", "show geofences of type alert"),
+        ("显示类型为禁飞的地理围栏", "显示类型为巡逻的地理围栏"),
+        ("查询过去24小时的无人机轨迹", "查询过去48小时的无人机轨迹"),
+        ("查询过去24小时的无人机轨迹", "查询过去24天的无人机轨迹"),
+        ("统计每架无人机的平均速度", "统计每架无人机的平均高度"),
+        ("查询 drone-001 的轨迹", "查询 drone-002 的轨迹"),
+        ("查询电量低于20的设备", "查询电量高于20的设备"),
+        ("显示所有无人机", "显示所有不在线的无人机"),
+    ],
+)
+def test_opposite_meaning_is_a_miss(cached, query):
+    cache = SemanticCache(near_match=True)
+    cache.add(cached, "SELECT 1")
+
+    assert cache.get(query) is None
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = SemanticCache(max_entries=2)
+    cache.add("query one", "SELECT 1")
+    cache.add("query two", "SELECT 2")
+    cache.get("query one")
+    cache.add("query three", "SELECT 3")
+
+    assert cache.get("query one") == "SELECT 1"
+    assert cache.get("query two") is None
+    assert cache.get("query three") == "SELECT 3"